@@ -13,18 +13,50 @@
 """
 
 import datetime
+import html
 import logging
 import os
-from uuid import uuid4
+import sqlite3
+import threading
+import time
 
 import requests
-from telegram import InlineQueryResultArticle, InputTextMessageContent, ParseMode
+from requests.adapters import HTTPAdapter
+from telegram import InlineQueryResultArticle, InputTextMessageContent, ParseMode, TelegramError
 from telegram.ext import Updater, CommandHandler, InlineQueryHandler
+from telegram.ext.dispatcher import run_async
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+#: HTTP session reusing the connection to Sodexo between requests.
+_http = requests.Session()
+_http.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+#: Sodexo daily menu of Hiomotie 32, formatted with the date of the menu.
+menu_url = 'http://www.sodexo.fi/ruokalistat/output/daily_json/89/{0.year}/{0.month}/{0.day}/fi'
+
+#: Sodexo responses and their messages cached per day, so only the first request of the day reaches the network.
+_menu_cache = {
+    'today': {'date': None, 'expires': None},
+    'tomorrow': {'date': None, 'expires': None},
+}
+#: Seconds before an empty menu is requested again, in case Sodexo publishes it later in the day.
+empty_menu_ttl = 60 * 60
+_menu_cache_lock = threading.Lock()
+
+#: Chat ids that receive the menu everyday, persisted to disk so they survive restarts.
+subscribers_path = os.environ.get('SUBSCRIBERS_PATH', 'subscribers.db')
+subscribers = set()
+_subscribers_db = None
+_subscribers_lock = threading.Lock()
+
 help_text = """You can control me by sending me these commands:
 
 /food - I'll tell you the complete menu of the day.
@@ -34,6 +66,8 @@ help_text = """You can control me by sending me these commands:
 /subscribe - I'll send you a message everyday with the complete menu of the day.
 /unsubscribe - I'll stop sending you a message everyday."""
 
+start_text = 'Hi! I\'m HiomoBot! ' + help_text
+
 
 def start(bot, update):
     """
@@ -43,7 +77,7 @@ def start(bot, update):
     :param update: Telegram update event.
     """
 
-    update.message.reply_text('Hi! I\'m HiomoBot! ' + help_text)
+    update.message.reply_text(start_text)
 
 
 def help(bot, update):
@@ -57,6 +91,7 @@ def help(bot, update):
     update.message.reply_text(help_text)
 
 
+@run_async
 def food(bot, update):
     """
     Message with the complete menu of the day in both English and Finnish.
@@ -69,6 +104,7 @@ def food(bot, update):
     update.message.reply_text(message, parse_mode=ParseMode.HTML)
 
 
+@run_async
 def food_tomorrow(bot, update):
     """
     Message with the complete menu of tomorrow in both English and Finnish.
@@ -81,18 +117,37 @@ def food_tomorrow(bot, update):
     update.message.reply_text(message, parse_mode=ParseMode.HTML)
 
 
+def warm_menu_cache(bot, job):
+    """
+    Job that fetches the menu of the day ahead of time, so users and subscribers get it from the cache.
+
+    :param bot: Bot object.
+    :param job: Job object.
+    """
+
+    _menu_entry('today')
+
+
 def subscribed_food(bot, job):
     """
-    A message for the subscribers with the complete menu of the day in both English and Finnish.
+    Daily job that sends the subscribers a message with the complete menu of the day in both English and Finnish.
 
     :param bot: Bot object.
     :param job: Job object.
     """
 
     message = _food_msg()
-    bot.send_message(job.context, text=message, parse_mode=ParseMode.HTML)
+    with _subscribers_lock:
+        chat_ids = list(subscribers)
+
+    for chat_id in chat_ids:
+        try:
+            bot.send_message(chat_id, text=message, parse_mode=ParseMode.HTML)
+        except TelegramError as e:
+            logger.warning('Could not send the menu to chat "%s": %s', chat_id, e)
 
 
+@run_async
 def fooden(bot, update):
     """
     Message with the complete menu of the day in English only.
@@ -105,6 +160,7 @@ def fooden(bot, update):
     update.message.reply_text(message, parse_mode=ParseMode.HTML)
 
 
+@run_async
 def foodfi(bot, update):
     """
     Message with the complete menu of the day in Finnish only.
@@ -117,49 +173,46 @@ def foodfi(bot, update):
     update.message.reply_text(message, parse_mode=ParseMode.HTML)
 
 
-def subscribe(bot, update, args, job_queue, chat_data):
+def subscribe(bot, update):
     """
     This handler will subscribe a user to receive daily messages at 10:30 in the morning containing the complete menu
     of the day in both English and Finnish.
 
     :param bot: Bot object.
     :param update: Telegram update event.
-    :param args: Arguments from the user.
-    :param job_queue: Job Queue object created by the Updater.
-    :param chat_data: Dict to keep any data related to the chat that the update was sent in.
     """
 
-    chat_id = update.message.chat_id
-    job = job_queue.run_daily(subscribed_food, datetime.time(
-        10, 30), (0, 1, 2, 3, 4), context=chat_id)
-    chat_data['job'] = job
+    with _subscribers_lock, _subscribers_db:
+        subscribers.add(update.message.chat_id)
+        _subscribers_db.execute('INSERT OR IGNORE INTO subs (chat_id) VALUES (?)', (update.message.chat_id,))
 
     update.message.reply_text(
         'You are now subscribed to HiomoBot! You will receive the menu everyday at 10:30 AM.')
 
 
-def unsubscribe(bot, update, chat_data):
+def unsubscribe(bot, update):
     """
     This handler will unsubscribe a user from HiomoBot daily messages.
 
     :param bot: Bot object.
     :param update: Telegram update event.
-    :param chat_data: Dict to keep any data related to the chat that the update was sent in.
     """
 
-    if 'job' not in chat_data:
+    with _subscribers_lock, _subscribers_db:
+        subscribed = update.message.chat_id in subscribers
+        if subscribed:
+            subscribers.discard(update.message.chat_id)
+            _subscribers_db.execute('DELETE FROM subs WHERE chat_id = ?', (update.message.chat_id,))
+
+    if not subscribed:
         update.message.reply_text(
             'You can\'t unsubscribe if you have no subscription.')
         return
 
-    job = chat_data['job']
-    job.schedule_removal()
-
-    del chat_data['job']
-
     update.message.reply_text('You are now unsubscribed from HiomoBot.')
 
 
+@run_async
 def inlinequery(bot, update):
     """
     Handler that will answer inline queries.
@@ -170,22 +223,22 @@ def inlinequery(bot, update):
 
     results = []
 
-    results.append(InlineQueryResultArticle(id=uuid4(),
+    results.append(InlineQueryResultArticle(id='food',
                                             title="food",
                                             input_message_content=InputTextMessageContent(_food_msg(),
                                                                                           parse_mode=ParseMode.HTML),
                                             description='The complete menu of the day.'))
-    results.append(InlineQueryResultArticle(id=uuid4(),
+    results.append(InlineQueryResultArticle(id='fooden',
                                             title="fooden",
                                             input_message_content=InputTextMessageContent(_food_msg_en(),
                                                                                           parse_mode=ParseMode.HTML),
                                             description='The menu in English only.'))
-    results.append(InlineQueryResultArticle(id=uuid4(),
+    results.append(InlineQueryResultArticle(id='foodfi',
                                             title="foodfi",
                                             input_message_content=InputTextMessageContent(_food_msg_fi(),
                                                                                           parse_mode=ParseMode.HTML),
                                             description='The menu in Finnish only.'))
-    results.append(InlineQueryResultArticle(id=uuid4(),
+    results.append(InlineQueryResultArticle(id='foodtomorrow',
                                             title="foodtomorrow",
                                             input_message_content=InputTextMessageContent(_food_msg_tomorrow(),
                                                                                           parse_mode=ParseMode.HTML),
@@ -203,7 +256,20 @@ def error(bot, update, error):
     :param error: Error message.
     """
 
-    logger.warning('Update "%s" caused error "%s"' % (update, error))
+    logger.warning('Update "%s" caused error "%s"', update, error)
+
+
+def _load_subscribers():
+    """
+    Opens the subscribers database and loads the chat ids of the subscribers into memory.
+    """
+
+    global _subscribers_db
+
+    _subscribers_db = sqlite3.connect(subscribers_path, check_same_thread=False)
+    with _subscribers_db:
+        _subscribers_db.execute('CREATE TABLE IF NOT EXISTS subs (chat_id INTEGER PRIMARY KEY)')
+    subscribers.update(chat_id for chat_id, in _subscribers_db.execute('SELECT chat_id FROM subs'))
 
 
 def _food_msg():
@@ -213,26 +279,7 @@ def _food_msg():
     :return: Menu of the day in both English and Finnish.
     """
 
-    menu = _get_menu_today()
-    has_menu = False
-
-    message = 'Today - %s' % (datetime.date.today().strftime('%d.%m.%Y'))
-    for course in menu.get('courses', []):
-        has_menu = True
-        title_fi = course.get('title_fi', 'NA')
-        title_en = course.get('title_en', 'NA')
-        properties = course.get('properties', 'NA')
-        category = course.get('category', None)
-
-        if category == 'Dessert':
-            message += '\nDessert: %s.\n%s. %s\n' % (
-                title_fi, title_en, properties)
-        else:
-            message += '\n%s.\n%s. %s\n' % (title_fi, title_en, properties)
-
-    if not has_menu:
-        message = '\nNo menu available today. Sorry!'
-    return message
+    return _menu_entry('today')['msg_both']
 
 
 def _food_msg_tomorrow():
@@ -242,27 +289,7 @@ def _food_msg_tomorrow():
     :return: Menu of tomorrow in both English and Finnish.
     """
 
-    menu = _get_menu_tomorrow()
-    has_menu = False
-
-    message = 'Tomorrow - %s' % ((datetime.date.today() +
-                                  datetime.timedelta(days=1)).strftime('%d.%m.%Y'))
-    for course in menu.get('courses', []):
-        has_menu = True
-        title_fi = course.get('title_fi', 'NA')
-        title_en = course.get('title_en', 'NA')
-        properties = course.get('properties', 'NA')
-        category = course.get('category', None)
-
-        if category == 'Dessert':
-            message += '\nDessert: %s.\n%s. %s\n' % (
-                title_fi, title_en, properties)
-        else:
-            message += '\n%s.\n%s. %s\n' % (title_fi, title_en, properties)
-
-    if not has_menu:
-        message = '\nNo menu available tomorrow. Sorry!'
-    return message
+    return _menu_entry('tomorrow')['msg_both']
 
 
 def _food_msg_en():
@@ -272,24 +299,7 @@ def _food_msg_en():
     :return: Menu of the day in English.
     """
 
-    menu = _get_menu_today()
-    has_menu = False
-
-    message = 'Today - %s' % (datetime.date.today().strftime('%d.%m.%Y'))
-    for course in menu.get('courses', []):
-        has_menu = True
-        title_en = course.get('title_en', 'NA')
-        properties = course.get('properties', 'NA')
-        category = course.get('category', None)
-
-        if category == 'Dessert':
-            message += '\nDessert: %s. %s\n' % (title_en, properties)
-        else:
-            message += '\n%s. %s\n' % (title_en, properties)
-
-    if not has_menu:
-        message = '\nNo menu available today. Sorry!'
-    return message
+    return _menu_entry('today')['msg_en']
 
 
 def _food_msg_fi():
@@ -299,52 +309,95 @@ def _food_msg_fi():
     :return: Menu of the day in Finnish.
     """
 
-    menu = _get_menu_today()
-    has_menu = False
+    return _menu_entry('today')['msg_fi']
+
+
+def _build_msgs(menu, key, day):
+    """
+    Builds the message strings of the menu in both languages, English and Finnish, going through the courses once.
+    Course texts are escaped here, once a day, since the messages are sent with the HTML parse mode.
+
+    :param menu: Menu in JSON.
+    :param key: Either 'today' or 'tomorrow'.
+    :param day: Date of the menu.
+    :return: Tuple with the menu in both English and Finnish, in English and in Finnish.
+    """
 
-    message = 'Today - %s' % (datetime.date.today().strftime('%d.%m.%Y'))
-    for course in menu.get('courses', []):
-        has_menu = True
-        title_fi = course.get('title_fi', 'NA')
-        properties = course.get('properties', 'NA')
-        category = course.get('category', None)
+    courses = menu.get('courses', [])
+    if not courses:
+        message = '\nNo menu available %s. Sorry!' % key
+        return message, message, message
 
-        if category == 'Dessert':
-            message += '\nDessert: %s. %s\n' % (title_fi, properties)
+    both, en, fi = [], [], []
+    for course in courses:
+        title_fi = html.escape(course.get('title_fi', 'NA'), quote=False)
+        title_en = html.escape(course.get('title_en', 'NA'), quote=False)
+        properties = html.escape(course.get('properties', 'NA'), quote=False)
+
+        if course.get('category') == 'Dessert':
+            both.append('\nDessert: %s.\n%s. %s\n' % (title_fi, title_en, properties))
+            en.append('\nDessert: %s. %s\n' % (title_en, properties))
+            fi.append('\nDessert: %s. %s\n' % (title_fi, properties))
         else:
-            message += '\n%s. %s\n' % (title_fi, properties)
+            both.append('\n%s.\n%s. %s\n' % (title_fi, title_en, properties))
+            en.append('\n%s. %s\n' % (title_en, properties))
+            fi.append('\n%s. %s\n' % (title_fi, properties))
 
-    if not has_menu:
-        message = '\nNo menu available today. Sorry!'
-    return message
+    header = '%s - %s' % (key.capitalize(), day.strftime('%d.%m.%Y'))
+    return header + ''.join(both), header + ''.join(en), header + ''.join(fi)
 
 
-def _get_menu_today():
+def _fetch_menu(day, previous=None):
     """
-    Sends a GET request to receive the Sodexo menu of the day of Hiomotie 32.
+    Sends a GET request to receive the Sodexo menu of Hiomotie 32 for the given day. If there is a previous response
+    for the same day, the request is conditional and Sodexo can answer that it was not modified.
 
-    :return: Response of the request in JSON.
+    :param day: Date of the menu.
+    :param previous: Cache entry with a previous response for the same day.
+    :return: Tuple with the response in JSON, its ETag and its Last-Modified headers.
     """
 
-    today = datetime.date.today()
-    url = 'http://www.sodexo.fi/ruokalistat/output/daily_json/89/%s/%s/%s/fi' % (
-        today.year, today.month, today.day)
-    r = requests.get(url)
-    return r.json()
+    url = menu_url.format(day)
+    headers = {}
+    if previous is not None:
+        if previous['etag']:
+            headers['If-None-Match'] = previous['etag']
+        if previous['last_modified']:
+            headers['If-Modified-Since'] = previous['last_modified']
+
+    r = _http.get(url, headers=headers, timeout=5)
+    if r.status_code == 304 and previous is not None:
+        return previous['json'], previous['etag'], previous['last_modified']
+
+    menu = r.json() if ujson is None else ujson.loads(r.content)
+    return menu, r.headers.get('ETag'), r.headers.get('Last-Modified')
 
 
-def _get_menu_tomorrow():
+def _menu_entry(key):
     """
-    Sends a GET request to receive the Sodexo menu of tomorrow of Hiomotie 32.
+    Returns the cached menu and message strings for today or tomorrow. On the first call of the day, a GET request is
+    sent to receive the Sodexo menu of Hiomotie 32 and the messages are built once for every user. Empty menus are
+    requested again after an hour.
 
-    :return: Response of the request in JSON.
+    :param key: Cache entry to use, either 'today' or 'tomorrow'.
+    :return: Dict with the menu in JSON and its 'msg_both', 'msg_en' and 'msg_fi' message strings.
     """
 
-    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
-    url = 'http://www.sodexo.fi/ruokalistat/output/daily_json/89/%s/%s/%s/fi' % (
-        tomorrow.year, tomorrow.month, tomorrow.day)
-    r = requests.get(url)
-    return r.json()
+    day = datetime.date.today()
+    if key == 'tomorrow':
+        day += datetime.timedelta(days=1)
+
+    with _menu_cache_lock:
+        entry = _menu_cache[key]
+        if entry['date'] != day or (entry['expires'] is not None and time.time() >= entry['expires']):
+            # Yesterday's menu of tomorrow is a previous response for today's menu.
+            previous = next((e for e in _menu_cache.values() if e['date'] == day), None)
+            menu, entry['etag'], entry['last_modified'] = _fetch_menu(day, previous)
+            entry['json'] = menu
+            entry['msg_both'], entry['msg_en'], entry['msg_fi'] = _build_msgs(menu, key, day)
+            entry['expires'] = None if menu.get('courses') else time.time() + empty_menu_ttl
+            entry['date'] = day
+        return entry
 
 
 def main():
@@ -361,15 +414,18 @@ def main():
     dispatcher.add_handler(CommandHandler('fooden', fooden))
     dispatcher.add_handler(CommandHandler('foodfi', foodfi))
     dispatcher.add_handler(CommandHandler('foodtomorrow', food_tomorrow))
-    dispatcher.add_handler(
-        CommandHandler('subscribe', subscribe, pass_args=True, pass_job_queue=True, pass_chat_data=True))
-    dispatcher.add_handler(CommandHandler(
-        'unsubscribe', unsubscribe, pass_chat_data=True))
+    dispatcher.add_handler(CommandHandler('subscribe', subscribe))
+    dispatcher.add_handler(CommandHandler('unsubscribe', unsubscribe))
 
     dispatcher.add_handler(InlineQueryHandler(inlinequery))
 
     dispatcher.add_error_handler(error)
 
+    _load_subscribers()
+    updater.job_queue.run_once(warm_menu_cache, 0)
+    updater.job_queue.run_daily(warm_menu_cache, datetime.time(10, 29), (0, 1, 2, 3, 4))
+    updater.job_queue.run_daily(subscribed_food, datetime.time(10, 30), (0, 1, 2, 3, 4))
+
     updater.start_webhook(listen='0.0.0.0', port=PORT, url_path=TOKEN)
     updater.bot.set_webhook('https://hiomo-bot.herokuapp.com/' + TOKEN)
     updater.idle()